@@ -9,14 +9,29 @@ Created on Mon June 19 12:00:00 2023
 """
 import aind_ng_mesh.meshing as meshing
 import boto3
-import json
+import gzip
 import numpy as np
+import orjson
 import os
-import shutil
 import tensorstore as ts
+from botocore.config import Config
+from contextlib import contextmanager
+from s3transfer.manager import TransferConfig, TransferManager
 from tifffile import imread
 import zarr
 
+_s3_clients = dict()
+
+# Shared tensorstore context: a real cache pool plus enough copy and io
+# concurrency to keep every core busy while chunks encode and flush
+_ts_context = ts.Context(
+    {
+        "cache_pool": {"total_bytes_limit": 1 << 30},
+        "data_copy_concurrency": {"limit": os.cpu_count()},
+        "file_io_concurrency": {"limit": 32},
+    }
+)
+
 
 def mkdir(path_to_dir):
     """
@@ -36,14 +51,19 @@ def mkdir(path_to_dir):
         os.mkdir(path_to_dir)
 
 
-def read_block(path):
+def read_block(path, lazy=False):
     """
-    Uploads image volume stored at "path" on local machine.
+    Uploads image volume stored at "path" on local machine. N5 volumes
+    are read with tensorstore, which issues concurrent chunk reads.
 
     Parameters
     ----------
     path : str
         Path where block is stored.
+    lazy : bool, optional
+        Indication of whether to return a lazy view that can be sliced
+        without loading the full volume into memory. The default value
+        is False.
 
     Returns
     -------
@@ -51,22 +71,80 @@ def read_block(path):
 
     """
     if "tif" in path:
+        if lazy:
+            return zarr.open(imread(path, aszarr=True), "r")
         return imread(path)
     elif ".n5" in path:
-        return zarr.open(zarr.N5FSStore(path), "r").volume[:]
+        spec = {
+            "driver": "n5",
+            "kvstore": {"driver": "file", "path": path},
+            "path": "volume",
+        }
+        # zarr presents n5 volumes in (z, y, x) order while tensorstore
+        # exposes the native (x, y, z) order, so transpose to match
+        dataset = ts.open(spec, read=True, context=_ts_context).result().T
+        if lazy:
+            return dataset
+        return dataset.read().result()
+
+
+def get_s3_client(access_id=None, secret_access_key=None, accelerate=False):
+    """
+    Gets the shared s3 client. The client is created once and reused
+    across calls since session creation is expensive and the default
+    connection pool is too small for concurrent uploads.
+
+    Parameters
+    ----------
+    access_id : str, optional
+        AWS access_id that is part of AWS credentials. This value is only
+        required if the bucket is private. The default value is None.
+    secret_access_key : str, optional
+        AWS secret_access_key that is part of AWS credentials. This value
+        is only required if the bucket is private. The default value is
+        None.
+    accelerate : bool, optional
+        Indication of whether to upload through the s3 Transfer
+        Acceleration endpoint, which routes traffic through the nearest
+        edge location. Requires the bucket to have acceleration enabled.
+        The default value is False.
+
+    Returns
+    -------
+    botocore.client.S3
+
+    """
+    key = (access_id, accelerate)
+    if key not in _s3_clients:
+        session = boto3.Session(
+            aws_access_key_id=access_id,
+            aws_secret_access_key=secret_access_key,
+        )
+        _s3_clients[key] = session.client(
+            "s3",
+            config=Config(
+                max_pool_connections=64,
+                retries={"max_attempts": 10, "mode": "adaptive"},
+                tcp_keepalive=True,
+                s3={"use_accelerate_endpoint": accelerate},
+            ),
+        )
+    return _s3_clients[key]
 
 
 def write_to_s3(
     labels,
     meshes,
-    root_dir,
     bucket,
     s3_prefix,
     access_id=None,
     access_key=None,
+    accelerate=False,
+    bundle_manifests=False,
 ):
     """
-    Writes to "labels" and "meshes" to an s3 bucket.
+    Writes "labels" and "meshes" to an s3 bucket. Data is streamed
+    directly to s3 without being written to the local machine first.
 
     Parameters
     ----------
@@ -75,33 +153,46 @@ def write_to_s3(
     meshes : dict
         Dictionary of meshes where the keys are object ids and values are
         meshes.
-    root_dir : str
-        Directory where files will be written to inorder to write to s3. This
-        directory is deleted after the files are uploaded.
     bucket : str
         Name of s3 bucket.
     s3_prefix : str
         Path where data will be stored in "bucket".
+    accelerate : bool, optional
+        Indication of whether to upload through the s3 Transfer
+        Acceleration endpoint. Requires the bucket to have acceleration
+        enabled. Only applies to uploads made with the s3 client
+        (meshes, manifests, info files); the tensorstore write of the
+        labels volume uses the standard regional endpoint. The default
+        value is False.
+    bundle_manifests : bool, optional
+        Indication of whether to upload all mesh manifests as a single
+        gzip compressed json object instead of one object per mesh. See
+        meshing.save_mesh_to_s3. The default value is False.
 
     Returns
     -------
     None
 
     """
-    # Write labels and meshes to local machine
-    upload_dir = os.path.join(root_dir, "upload_dir")
-    write_to_local(labels, meshes, upload_dir)
-
     # Write to s3
+    s3_client = get_s3_client(access_id, access_key, accelerate=accelerate)
     print("Writing to s3 bucket...")
-    to_s3(
-        upload_dir,
-        bucket,
+    write_precomputed(
+        labels,
         s3_prefix,
+        bucket=bucket,
         access_id=access_id,
         secret_access_key=access_key,
     )
-    shutil.rmtree(upload_dir)
+    obj_ids = meshing.save_mesh_to_s3(
+        meshes,
+        s3_client,
+        bucket,
+        f"{s3_prefix}/mesh",
+        bundle_manifests=bundle_manifests,
+    )
+    write_segment_properties_to_s3(s3_client, bucket, s3_prefix, obj_ids)
+    edit_info_s3(s3_client, bucket, s3_prefix)
 
 
 def write_to_local(labels, meshes, root_dir):
@@ -135,7 +226,12 @@ def write_to_local(labels, meshes, root_dir):
 
 
 def to_s3(
-    directory_path, bucket, s3_prefix, access_id=None, secret_access_key=None
+    directory_path,
+    bucket,
+    s3_prefix,
+    access_id=None,
+    secret_access_key=None,
+    accelerate=False,
 ):
     """
     Uploads a directory to an s3 bucket.
@@ -154,38 +250,50 @@ def to_s3(
     secret_access_key : str, optional
         AWS secret_access_key that is part of AWS credentials. This value is
         only required if the bucket is private. The default value is None.
+    accelerate : bool, optional
+        Indication of whether to upload through the s3 Transfer
+        Acceleration endpoint. Requires the bucket to have acceleration
+        enabled. The default value is False.
 
     Returns
     -------
     None
 
     """
-    # Create session
-    session = boto3.Session()
-    s3_client = session.client("s3")
+    # Create client
+    s3_client = get_s3_client(
+        access_id, secret_access_key, accelerate=accelerate
+    )
+    transfer_config = TransferConfig(
+        max_request_concurrency=32,
+        max_submission_concurrency=8,
+        multipart_chunksize=8 * 1024 * 1024,
+    )
 
     # Upload files
-    for root, dirs, files in os.walk(directory_path):
-        for file_name in files:
-            local_path = os.path.join(root, file_name)
-            s3_key = os.path.join(
-                s3_prefix, os.path.relpath(local_path, directory_path)
+    with TransferManager(s3_client, config=transfer_config) as manager:
+        futures = []
+        for root, _, files in os.walk(directory_path):
+            rel_root = os.path.relpath(root, directory_path)
+            s3_root = (
+                s3_prefix if rel_root == "." else f"{s3_prefix}/{rel_root}"
             )
+            for file_name in files:
+                local_path = os.path.join(root, file_name)
+                s3_key = f"{s3_root}/{file_name}"
+                futures.append(manager.upload(local_path, bucket, s3_key))
 
-            s3_client.upload_file(local_path, bucket, s3_key)
-
-        for dir_name in dirs:
-            local_dir_path = os.path.join(root, dir_name)
-            s3_dir_key = (
-                os.path.join(
-                    s3_prefix, os.path.relpath(local_dir_path, directory_path)
-                )
-                + "/"
-            )
-            s3_client.put_object(Body="", Bucket=bucket, Key=s3_dir_key)
+        for future in futures:
+            future.result()
 
 
-def write_precomputed(block, path):
+def write_precomputed(
+    block,
+    path,
+    bucket=None,
+    access_id=None,
+    secret_access_key=None,
+):
     """
     Writes block as precomputed.
 
@@ -194,31 +302,142 @@ def write_precomputed(block, path):
     block : numpy.array
         Block to be written as precomputed.
     path : str
-        Path where block is to be written to.
+        Path where block is to be written to. If "bucket" is provided,
+        this is interpreted as a prefix within that bucket.
+    bucket : str, optional
+        Name of s3 bucket that block is written to. If provided, the
+        block is streamed directly to s3 by tensorstore. The default
+        value is None.
+    access_id : str, optional
+        AWS access_id that is part of AWS credentials. This value is only
+        required if the bucket is private. The default value is None.
+    secret_access_key : str, optional
+        AWS secret_access_key that is part of AWS credentials. This value
+        is only required if the bucket is private. The default value is
+        None.
 
     Returns
     -------
     None
 
     """
+    if bucket is None:
+        kvstore = {"driver": "file", "path": path}
+    else:
+        kvstore = {"driver": "s3", "bucket": bucket, "path": path}
     spec = {
-        "dtype": "uint16",
+        "dtype": "uint32",
         "driver": "neuroglancer_precomputed",
-        "kvstore": {
-            "driver": "file",
-            "path": path,
+        "kvstore": kvstore,
+        "scale_metadata": {
+            "encoding": "compressed_segmentation",
+            "compressed_segmentation_block_size": [8, 8, 8],
+            "sharding": {
+                "@type": "neuroglancer_uint64_sharded_v1",
+                "preshift_bits": 6,
+                "hash": "identity",
+                "minishard_bits": 2,
+                "shard_bits": 1,
+                "minishard_index_encoding": "gzip",
+                "data_encoding": "gzip",
+            },
         },
         "create": True,
         "delete_existing": True,
     }
+    block = block.astype(np.uint32, copy=False)
     shape = block.shape + (1,)
-    dataset = ts.open(
-        spec,
-        dtype=ts.uint16,
-        shape=shape,
-    ).result().T
-    write_future = dataset.write(block)
-    edit_info(path)
+    with aws_credentials_env(access_id, secret_access_key):
+        dataset = ts.open(
+            spec,
+            dtype=ts.uint32,
+            shape=shape,
+            context=_ts_context,
+        ).result().T
+        # Edit info while chunks flush in the background, then block
+        # until all writes are committed so callers never see partial
+        # data
+        futures = write_aligned(dataset, block)
+        if bucket is None:
+            edit_info(path)
+        for future in futures:
+            future.result()
+
+
+@contextmanager
+def aws_credentials_env(access_id, secret_access_key):
+    """
+    Temporarily exports AWS credentials to the environment variables
+    that tensorstore's default credential chain resolves, restoring the
+    prior values on exit so the rest of the process is unaffected.
+
+    Parameters
+    ----------
+    access_id : str or None
+        AWS access_id that is part of AWS credentials. Ignored if None.
+    secret_access_key : str or None
+        AWS secret_access_key that is part of AWS credentials. Ignored
+        if None.
+
+    Returns
+    -------
+    None
+
+    """
+    creds = {
+        "AWS_ACCESS_KEY_ID": access_id,
+        "AWS_SECRET_ACCESS_KEY": secret_access_key,
+    }
+    saved = {
+        name: os.environ.get(name)
+        for name, value in creds.items()
+        if value is not None
+    }
+    try:
+        for name in saved.keys():
+            os.environ[name] = creds[name]
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def write_aligned(dataset, block):
+    """
+    Writes "block" to "dataset" in write-chunk-aligned slabs so that
+    tensorstore never has to read-modify-write partial chunks and can
+    encode slabs concurrently.
+
+    Parameters
+    ----------
+    dataset : tensorstore.TensorStore
+        Dataset that block is written to.
+    block : numpy.array
+        Block to be written to "dataset".
+
+    Returns
+    -------
+    List[tensorstore.Future]
+
+    """
+    futures = []
+    cz, cy, cx = dataset.chunk_layout.write_chunk.shape[-3:]
+    nz, ny, nx = block.shape
+    for z in range(0, nz, cz):
+        for y in range(0, ny, cy):
+            for x in range(0, nx, cx):
+                z1 = min(z + cz, nz)
+                y1 = min(y + cy, ny)
+                x1 = min(x + cx, nx)
+                futures.append(
+                    dataset[..., z:z1, y:y1, x:x1].write(
+                        block[z:z1, y:y1, x:x1]
+                    )
+                )
+    return futures
 
 
 def edit_info(precomputed_dir):
@@ -244,38 +463,111 @@ def edit_info(precomputed_dir):
     write_json(path, info)
 
 
-def write_segment_properties(root_dir, seg_ids):
+def edit_info_s3(s3_client, bucket, s3_prefix):
     """
-    Writes info file that is used to upload meshes into neuroglancer.
+    Edits info file stored in an s3 bucket so that it points to the mesh
+    directory.
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        Client used to read and write the info file.
+    bucket : str
+        Name of s3 bucket that contains precomputed labels.
+    s3_prefix : str
+        Path in "bucket" that contains precomputed labels.
+
+    Returns
+    -------
+    None
+
+    """
+    key = f"{s3_prefix}/info"
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    info = orjson.loads(response["Body"].read())
+    info["type"] = "segmentation"
+    info["mesh"] = "mesh"
+    info["segment_properties"] = "segment_properties"
+    upload_json(s3_client, bucket, key, info)
+
+
+def make_segment_properties(seg_ids):
+    """
+    Makes contents of info file that is used to upload meshes into
+    neuroglancer.
 
     Parameters
     ----------
-    root_dir : str
-        Path that info file is written to.
     seg_ids : List[str]
         List of segmentation ids.
 
     Returns
     -------
-    None
+    dict
 
     """
-    info = {
+    str_ids = np.asarray(list(seg_ids)).astype(str).tolist()
+    return {
         "@type": "neuroglancer_segment_properties",
         "inline": {
-            "ids": list(map(str, seg_ids)),
+            "ids": str_ids,
             "properties": [
                 {
                     "id": "label",
                     "type": "label",
-                    "values": list(map(str, seg_ids)),
+                    "values": str_ids,
                 }
             ],
         },
     }
+
+
+def write_segment_properties(root_dir, seg_ids):
+    """
+    Writes info file that is used to upload meshes into neuroglancer.
+
+    Parameters
+    ----------
+    root_dir : str
+        Path that info file is written to.
+    seg_ids : List[str]
+        List of segmentation ids.
+
+    Returns
+    -------
+    None
+
+    """
     property_dir = os.path.join(root_dir, "segment_properties")
     mkdir(property_dir)
-    write_json(os.path.join(property_dir, "info"), info)
+    write_json(
+        os.path.join(property_dir, "info"), make_segment_properties(seg_ids)
+    )
+
+
+def write_segment_properties_to_s3(s3_client, bucket, s3_prefix, seg_ids):
+    """
+    Writes info file that is used to upload meshes into neuroglancer to
+    an s3 bucket.
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        Client used to write the info file.
+    bucket : str
+        Name of s3 bucket that info file is written to.
+    s3_prefix : str
+        Path in "bucket" that info file is written to.
+    seg_ids : List[str]
+        List of segmentation ids.
+
+    Returns
+    -------
+    None
+
+    """
+    key = f"{s3_prefix}/segment_properties/info"
+    upload_json(s3_client, bucket, key, make_segment_properties(seg_ids))
 
 
 def read_json(path):
@@ -292,8 +584,8 @@ def read_json(path):
     dict
 
     """
-    with open(path, "r") as f:
-        data = json.load(f)
+    with open(path, "rb") as f:
+        data = orjson.loads(f.read())
     return data
 
 
@@ -313,5 +605,58 @@ def write_json(path, data):
     None
 
     """
-    with open(path, "w") as f:
-        json.dump(data, f)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(data))
+
+
+def upload_json(s3_client, bucket, key, data):
+    """
+    Uploads "data" as json object stored at "key" in "bucket".
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        Client used to upload the json object.
+    bucket : str
+        Name of s3 bucket that json object is written to.
+    key : str
+        Path in "bucket" that json object is written to.
+    data : dict or list
+        Data to written to json object.
+
+    Returns
+    -------
+    None
+
+    """
+    s3_client.put_object(Body=orjson.dumps(data), Bucket=bucket, Key=key)
+
+
+def upload_gzipped_json(s3_client, bucket, key, data):
+    """
+    Uploads "data" as a gzip compressed json object stored at "key" in
+    "bucket".
+
+    Parameters
+    ----------
+    s3_client : botocore.client.S3
+        Client used to upload the json object.
+    bucket : str
+        Name of s3 bucket that json object is written to.
+    key : str
+        Path in "bucket" that json object is written to.
+    data : dict or list
+        Data to written to json object.
+
+    Returns
+    -------
+    None
+
+    """
+    s3_client.put_object(
+        Body=gzip.compress(orjson.dumps(data)),
+        Bucket=bucket,
+        Key=key,
+        ContentEncoding="gzip",
+        ContentType="application/json",
+    )
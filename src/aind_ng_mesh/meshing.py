@@ -3,33 +3,102 @@ Mesh generation and io routines
 
 """
 import aind_ng_mesh.io_utils as utils
+import numpy as np
 import os
-from zmesh import Mesher
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from zmesh import Mesh, Mesher
 
 
 # Mesh generation
-def labels_to_meshes(labels, anisotropy=(1.0, 1.0, 1.0)):
-    # Initial mesh
+def labels_to_meshes(
+    labels, anisotropy=(1.0, 1.0, 1.0), tile_shape=(256, 256, 256)
+):
+    # Mesh one tile at a time to keep the working set small
     print("Generating mesh...")
-    mesher = Mesher(anisotropy)
-    mesher.mesh(labels, close=True)
+    tile_meshes = dict()
+    for origin, tile in get_tiles(labels, tile_shape):
+        for obj_id, mesh in mesh_tile(tile, origin, anisotropy).items():
+            tile_meshes.setdefault(obj_id, []).append(mesh)
+
+    # Merge and simplify each object
+    meshes = dict()
+    for obj_id, parts in tile_meshes.items():
+        meshes[obj_id] = finalize_mesh(parts, anisotropy)
+    return meshes
+
+
+def finalize_mesh(parts, anisotropy):
+    mesh = merge_meshes(parts)
+    return simplify_mesh(Mesher(anisotropy), mesh)
 
-    # Extract and simplify
+
+def get_tiles(labels, tile_shape):
+    # One-voxel halo on the high side so marching cubes cells that span
+    # tile boundaries are generated by exactly one tile. Tiles on the
+    # volume border are padded with background so surfaces are capped
+    # there, matching what close=True did before tiling
+    nz, ny, nx = labels.shape
+    tz, ty, tx = tile_shape
+    for z in range(0, nz, tz):
+        for y in range(0, ny, ty):
+            for x in range(0, nx, tx):
+                z1 = min(z + tz + 1, nz)
+                y1 = min(y + ty + 1, ny)
+                x1 = min(x + tx + 1, nx)
+                pad = (
+                    (int(z == 0), int(z1 == nz)),
+                    (int(y == 0), int(y1 == ny)),
+                    (int(x == 0), int(x1 == nx)),
+                )
+                tile = labels[z:z1, y:y1, x:x1]
+                if any(sum(p) for p in pad):
+                    tile = np.pad(tile, pad)
+                yield (z - pad[0][0], y - pad[1][0], x - pad[2][0]), tile
+
+
+def mesh_tile(tile, origin, anisotropy):
+    mesher = Mesher(anisotropy)
+    mesher.mesh(tile, close=False)
     meshes = dict()
     for obj_id in mesher.ids():
         mesh = extract_mesh(mesher, obj_id)
-        mesh = simplify_mesh(mesher, mesh)
-        mesh.triangles()
+        # Vertices are in (x, y, z) order while origin is in numpy
+        # (z, y, x) order
+        mesh.vertices += np.multiply(origin[::-1], anisotropy)
         meshes[obj_id] = mesh
     mesher.clear()
     return meshes
 
 
+def merge_meshes(meshes):
+    if len(meshes) == 1:
+        return meshes[0]
+    vertices = []
+    faces = []
+    offset = 0
+    for mesh in meshes:
+        vertices.append(mesh.vertices)
+        faces.append(mesh.faces + offset)
+        offset += len(mesh.vertices)
+
+    # Weld coincident seam vertices so simplification can cross tile
+    # boundaries
+    vertices, inverse = np.unique(
+        np.concatenate(vertices), axis=0, return_inverse=True
+    )
+    faces = inverse[np.concatenate(faces)]
+    return Mesh(vertices, faces, None)
+
+
 def extract_mesh(mesher, obj_id):
+    # No per-tile decimation so seam vertices on adjacent tiles stay
+    # coincident and can be welded before the final simplify
     mesh = mesher.get_mesh(
         obj_id,
         normals=False,
-        simplification_factor=100,
+        simplification_factor=1,
         voxel_centered=False,
     )
     mesher.erase(obj_id)
@@ -51,11 +120,15 @@ def simplify_mesh(mesher, mesh):
 def save_mesh(meshes, mesh_dir):
     utils.mkdir(mesh_dir)
     write_mesh_info(mesh_dir)
-    for obj_id in meshes.keys():
-        filename = f"{obj_id}:0:0000000000000000"
-        write_mesh_filenames(mesh_dir, obj_id)
-        with open(os.path.join(mesh_dir, filename), "wb") as f:
-            f.write(meshes[obj_id].to_precomputed())
+    for obj_id, mesh in meshes.items():
+        # Format the id once and reuse it for the fragment and manifest
+        sid = str(obj_id)
+        fragment = f"{sid}:0:0000000000000000"
+        utils.write_json(
+            os.path.join(mesh_dir, f"{sid}:0"), {"fragments": [fragment]}
+        )
+        with open(os.path.join(mesh_dir, fragment), "wb") as f:
+            f.write(mesh.to_precomputed())
     return meshes.keys()
 
 
@@ -65,7 +138,64 @@ def write_mesh_info(mesh_dir):
     utils.write_json(path, info)
 
 
-def write_mesh_filenames(mesh_dir, obj_id):
-    path = f"{mesh_dir}/{obj_id}:{0}"
-    data = {"fragments": [f"{obj_id}:0:0000000000000000"]}
-    utils.write_json(path, data)
+# Save mesh to s3
+def save_mesh_to_s3(meshes, s3_client, bucket, prefix, bundle_manifests=False):
+    write_mesh_info_to_s3(s3_client, bucket, prefix)
+    if bundle_manifests:
+        write_manifest_bundle_to_s3(s3_client, bucket, prefix, meshes.keys())
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        processes = []
+        for obj_id, mesh in meshes.items():
+            # Format the id once and reuse it for the fragment and
+            # manifest
+            sid = str(obj_id)
+            fragment = f"{sid}:0:0000000000000000"
+            if not bundle_manifests:
+                processes.append(
+                    executor.submit(
+                        utils.upload_json,
+                        s3_client,
+                        bucket,
+                        f"{prefix}/{sid}:0",
+                        {"fragments": [fragment]},
+                    )
+                )
+            processes.append(
+                executor.submit(
+                    upload_mesh_to_s3,
+                    s3_client,
+                    bucket,
+                    f"{prefix}/{fragment}",
+                    mesh,
+                )
+            )
+        for process in processes:
+            process.result()
+    return meshes.keys()
+
+
+def upload_mesh_to_s3(s3_client, bucket, key, mesh):
+    s3_client.upload_fileobj(
+        BytesIO(mesh.to_precomputed()),
+        bucket,
+        key,
+        Config=TransferConfig(use_threads=True, max_concurrency=8),
+    )
+
+
+def write_mesh_info_to_s3(s3_client, bucket, prefix):
+    info = {"@type": "neuroglancer_legacy_mesh"}
+    utils.upload_json(s3_client, bucket, f"{prefix}/info", info)
+
+
+def write_manifest_bundle_to_s3(s3_client, bucket, prefix, obj_ids):
+    # One gzip'd object holding every per-object manifest. Note that
+    # neuroglancer expects individual "{obj_id}:0" keys, so consumers of
+    # the bundle must fetch and index it themselves
+    bundle = dict()
+    for obj_id in obj_ids:
+        sid = str(obj_id)
+        bundle[f"{sid}:0"] = {"fragments": [f"{sid}:0:0000000000000000"]}
+    utils.upload_gzipped_json(
+        s3_client, bucket, f"{prefix}/manifests.json.gz", bundle
+    )
@@ -0,0 +1,36 @@
+"""Tests for read and write routines."""
+
+import os
+import tempfile
+import unittest
+
+try:
+    import numpy as np
+    import zarr
+    from aind_ng_mesh import io_utils
+
+    DEPS_INSTALLED = True
+except ImportError:
+    DEPS_INSTALLED = False
+
+
+@unittest.skipUnless(DEPS_INSTALLED, "io dependencies not installed")
+class ReadBlockTest(unittest.TestCase):
+    """Tests that read_block round-trips an n5 volume."""
+
+    def test_read_n5(self):
+        """Writes an n5 volume with zarr and reads it back."""
+        block = np.arange(40 * 50 * 60, dtype=np.uint16).reshape(40, 50, 60)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "block.n5")
+            root = zarr.open(zarr.N5FSStore(path), mode="w")
+            root.create_dataset("volume", data=block, chunks=(20, 20, 20))
+            np.testing.assert_array_equal(io_utils.read_block(path), block)
+            lazy = io_utils.read_block(path, lazy=True)
+            np.testing.assert_array_equal(
+                np.asarray(lazy[:10, :20, :30]), block[:10, :20, :30]
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+"""Tests for mesh generation."""
+
+import unittest
+
+try:
+    import numpy as np
+    from aind_ng_mesh import meshing
+
+    DEPS_INSTALLED = True
+except ImportError:
+    DEPS_INSTALLED = False
+
+
+@unittest.skipUnless(DEPS_INSTALLED, "meshing dependencies not installed")
+class TilingTest(unittest.TestCase):
+    """Tests that tiled meshing matches the untiled baseline."""
+
+    def test_tiled_matches_untiled(self):
+        """Meshes a cube with and without tiling and compares bounds."""
+        labels = np.zeros((60, 60, 60), dtype=np.uint32)
+        labels[20:55, 20:55, 20:55] = 1
+        untiled = meshing.labels_to_meshes(labels, tile_shape=(64, 64, 64))
+        tiled = meshing.labels_to_meshes(labels, tile_shape=(32, 32, 32))
+        self.assertEqual(set(tiled.keys()), set(untiled.keys()))
+        for obj_id in untiled.keys():
+            np.testing.assert_allclose(
+                tiled[obj_id].vertices.min(axis=0),
+                untiled[obj_id].vertices.min(axis=0),
+                atol=2.0,
+            )
+            np.testing.assert_allclose(
+                tiled[obj_id].vertices.max(axis=0),
+                untiled[obj_id].vertices.max(axis=0),
+                atol=2.0,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()